@@ -3,6 +3,11 @@
 import machine
 import time
 
+DEBUG = False  # Print every sent message to the console
+
+MESSAGE_ID = 0x123
+DATA = b'CAN_OK'  # 6 bytes of data
+
 try:
     # Initialize the CAN interface (adjust TX/RX pins as required)
     can = machine.CAN(0, tx=machine.Pin(5), rx=machine.Pin(4), mode=machine.CAN.NORMAL, baudrate=500000)
@@ -11,20 +16,21 @@ except Exception as e:
     print("Error initializing CAN interface:", e)
     can = None
 
+_send = can.send if can else None
+
 def send_can_message():
     """
     Sends a simple CAN message periodically.
     Message ID: 0x123, Data: b'CAN_OK'
     """
     try:
-        message_id = 0x123
-        data = b'CAN_OK'  # 6 bytes of data
-        can.send(data, message_id)
-        print("CAN message sent:", data)
+        _send(DATA, MESSAGE_ID)
+        if DEBUG:
+            print("CAN message sent:", DATA)
     except Exception as e:
         print("Error sending CAN message:", e)
 
 while True:
-    if can:
+    if _send:
         send_can_message()
-    time.sleep(1)  # send every 1 second
+    time.sleep_ms(1000)  # send every 1 second
@@ -2,8 +2,14 @@
 
 import asyncio
 from logger_config import logger
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
 from config import (HTTP_PORT, ADC_INTERVAL, LIN_INTERVAL, MQTT_INTERVAL, WS_INTERVAL,
-                    PWM_PIN, TACH_PIN, PWM_FREQUENCY, PULSES_PER_REV)
+                    PWM_INTERVAL, PWM_PIN, TACH_PIN, PWM_FREQUENCY, PULSES_PER_REV,
+                    TACH_DEBOUNCE_US)
 from adc_manager import ADCManager
 from lin_communication import LinCommunication
 from mqtt_manager import MqttManager
@@ -19,7 +25,8 @@ adc_manager = ADCManager()
 lin_comm = LinCommunication()
 mqtt_manager = MqttManager()
 pwm_manager = PWMManager(pwm_pin=PWM_PIN, tachometer_pin=TACH_PIN, 
-                         frequency=PWM_FREQUENCY, pulses_per_rev=PULSES_PER_REV)
+                         frequency=PWM_FREQUENCY, pulses_per_rev=PULSES_PER_REV,
+                         tach_debounce_us=TACH_DEBOUNCE_US)
 
 # Initialize CAN bus (assuming SocketCAN is configured on 'can0')
 can_bus = init_can_interface()
@@ -29,16 +36,6 @@ mqtt_manager.start()
 # Provide MQTT client to webserver for command publishing
 set_mqtt_client(mqtt_manager.client)
 
-async def adc_loop():
-    while True:
-        adc_manager.process_all_adc_channels()
-        await asyncio.sleep(ADC_INTERVAL)
-
-async def lin_loop():
-    while True:
-        await lin_comm.process_lin_communication()
-        await asyncio.sleep(LIN_INTERVAL)
-
 async def can_loop():
     if can_bus is not None:
         await can_listener(can_bus)
@@ -47,52 +44,107 @@ async def can_loop():
         while True:
             await asyncio.sleep(1)
 
-async def mqtt_loop_task():
-    while True:
-        mqtt_manager.publish_to_mqtt()
-        await asyncio.sleep(MQTT_INTERVAL)
+async def adc_step():
+    # SPI ioctl runs in the default executor so the loop stays responsive;
+    # the thread only assigns existing keys in latest_data
+    await asyncio.to_thread(adc_manager.process_all_adc_channels)
 
-async def websocket_loop():
-    while True:
-        await broadcast_via_websocket()
-        await asyncio.sleep(WS_INTERVAL)
-
-async def pwm_loop():
+def apply_pwm_state():
     """Manage PWM fan based on shared_data state"""
+    try:
+        # Apply desired state from shared_data
+        desired_enabled = latest_data["pwm_fan"]["enabled"]
+        desired_duty = latest_data["pwm_fan"]["duty_cycle"]
+        
+        if desired_enabled and not pwm_manager.is_enabled:
+            pwm_manager.enable_pwm()
+            pwm_manager.set_duty_cycle(desired_duty)
+        elif not desired_enabled and pwm_manager.is_enabled:
+            pwm_manager.disable_pwm()
+        elif desired_enabled:
+            pwm_manager.set_duty_cycle(desired_duty)
+
+        # Update RPM once per second
+        latest_data["pwm_fan"]["rpm"] = pwm_manager.get_rpm()
+    except Exception as e:
+        logger.error(f"Error in PWM loop: {e}")
+
+async def pwm_step():
+    # Daemon HTTP requests block for up to their timeout, keep them off the loop;
+    # the scheduler never runs two pwm steps at once, so one thread owns the connection
+    await asyncio.to_thread(apply_pwm_state)
+
+# Periodic jobs: (name, interval, job). Jobs run on fixed deadlines
+# (due + interval); coroutine jobs run as tasks and are never overlapped,
+# a job that overruns its interval starts again as soon as it finishes.
+SCHEDULE = (
+    ("adc", ADC_INTERVAL, adc_step),
+    ("lin", LIN_INTERVAL, lin_comm.process_lin_communication),
+    ("mqtt", MQTT_INTERVAL, mqtt_manager.publish_to_mqtt),
+    ("ws", WS_INTERVAL, broadcast_via_websocket),
+    ("pwm", PWM_INTERVAL, pwm_step),
+)
+
+async def scheduler():
+    """
+    Runs all periodic jobs from a single task with one timer per wakeup.
+    """
+    loop = asyncio.get_running_loop()
+    jobs = [(name, interval, job, asyncio.iscoroutinefunction(job)) for name, interval, job in SCHEDULE]
+    next_due = {name: loop.time() for name, _, _, _ in jobs}
+    wakeup = asyncio.Event()
+
+    def reschedule(name, interval, due, task):
+        # Absolute cadence: the job's own run time does not add drift
+        next_due[name] = max(due + interval, loop.time())
+        # The scheduler may be sleeping past this job's new deadline
+        wakeup.set()
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Error in {name} job: {task.exception()}")
+
     while True:
+        wakeup.clear()
+        now = loop.time()
+        for name, interval, job, is_coroutine in jobs:
+            due = next_due[name]
+            if due > now:
+                continue
+            if is_coroutine:
+                # Not due again until the running task finishes
+                next_due[name] = float("inf")
+                task = asyncio.create_task(job())
+                task.add_done_callback(lambda t, n=name, i=interval, d=due: reschedule(n, i, d, t))
+            else:
+                try:
+                    job()
+                except Exception as e:
+                    logger.error(f"Error in {name} job: {e}")
+                next_due[name] = max(due + interval, loop.time())
+
+        sleep_for = min(next_due.values()) - loop.time()
         try:
-            # Apply desired state from shared_data
-            desired_enabled = latest_data["pwm_fan"]["enabled"]
-            desired_duty = latest_data["pwm_fan"]["duty_cycle"]
-            
-            if desired_enabled and not pwm_manager.is_enabled:
-                pwm_manager.enable_pwm()
-                pwm_manager.set_duty_cycle(desired_duty)
-            elif not desired_enabled and pwm_manager.is_enabled:
-                pwm_manager.disable_pwm()
-            elif desired_enabled:
-                pwm_manager.set_duty_cycle(desired_duty)
-
-            # Update RPM once per second
-            latest_data["pwm_fan"]["rpm"] = pwm_manager.get_rpm()
-        except Exception as e:
-            logger.error(f"Error in PWM loop: {e}")
-        
-        await asyncio.sleep(1)
+            # Wake on the next deadline or when a running job finishes
+            await asyncio.wait_for(wakeup.wait(), max(sleep_for, 0) if sleep_for != float("inf") else None)
+        except asyncio.TimeoutError:
+            pass
 
 async def main():
+    # Eager tasks (Python 3.12+) run synchronously until their first real await
+    eager_task_factory = getattr(asyncio, "eager_task_factory", None)
+    if eager_task_factory is not None:
+        asyncio.get_running_loop().set_task_factory(eager_task_factory)
+
     quart_task = asyncio.create_task(run_quart_server(HTTP_PORT))
-    adc_task = asyncio.create_task(adc_loop())
-    lin_task = asyncio.create_task(lin_loop())
     can_task = asyncio.create_task(can_loop())
-    mqtt_task = asyncio.create_task(mqtt_loop_task())
-    ws_task = asyncio.create_task(websocket_loop())
-    pwm_task = asyncio.create_task(pwm_loop())
+    scheduler_task = asyncio.create_task(scheduler())
 
     logger.info("All tasks started (ADC, LIN, CAN, MQTT, WebServer, WebSocket, PWM).")
-    await asyncio.gather(quart_task, adc_task, lin_task, can_task, mqtt_task, ws_task, pwm_task)
+    await asyncio.gather(quart_task, can_task, scheduler_task)
 
 if __name__ == '__main__':
+    if uvloop is not None:
+        uvloop.install()
+        logger.info("Using uvloop event loop.")
     try:
         asyncio.run(main())
     except KeyboardInterrupt:
@@ -103,9 +155,10 @@ if __name__ == '__main__':
         try:
             adc_manager.close()
             lin_comm.close()
+            if can_bus is not None:
+                can_bus.close()
             pwm_manager.close()
-            mqtt_manager.client.publish("cis3/status", "offline", retain=True)
-            mqtt_manager.client.disconnect()
+            mqtt_manager.stop()
             logger.info("ADC, LIN, CAN, MQTT & PWM Add-on has been shut down.")
         except Exception as e:
             logger.error(f"Error during shutdown: {e}")
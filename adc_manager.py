@@ -1,8 +1,11 @@
 # adc_manager.py
 
-import spidev
+import os
+import fcntl
+import ctypes
+import struct
 import logging
-from collections import deque
+import numpy as np
 
 from logger_config import logger
 from config import (SPI_BUS, SPI_DEVICE, SPI_SPEED_HZ, SPI_MODE, 
@@ -10,29 +13,107 @@ from config import (SPI_BUS, SPI_DEVICE, SPI_SPEED_HZ, SPI_MODE,
                     RESISTANCE_REFERENCE, VOLTAGE_THRESHOLD)
 from shared_data import latest_data
 
-# За Moving Average и Exponential Moving Average
-voltage_buffers = {ch: deque(maxlen=20) for ch in range(4)}      # Channels 0-3: Voltage
-resistance_buffers = {ch: deque(maxlen=30) for ch in range(4, 6)}# Channels 4-5: Resistance
-ema_values = {ch: None for ch in range(6)}                       # EMA стойности за всички канали
+# EMA коефициенти (заместват MA прозорци от 20/30 проби + EMA върху тях).
+# Избрани за същото 10-90% време на нарастване при стъпка като старите
+# филтри: MA(20)+EMA(0.2) -> 19 tick-а, MA(30)+EMA(0.1) -> 32 tick-а;
+# alpha = 1 - 9 ** (-1 / ticks)
+VOLTAGE_ALPHA = 0.11     # Channels 0-3: Voltage
+RESISTANCE_ALPHA = 0.066 # Channels 4-5: Resistance
+
+# raw -> волтове за канали 0-3 с едно умножение
+VOLTAGE_SCALE = VREF * VOLTAGE_MULTIPLIER / ADC_RESOLUTION
+
+ADC_CHANNELS = 6
+FRAME_SIZE = 3           # MCP3008: start, config, 0
+
+# ============================
+# Linux spidev ioctl интерфейс (linux/spi/spidev.h)
+# ============================
+class SpiIocTransfer(ctypes.Structure):
+    _fields_ = [
+        ("tx_buf", ctypes.c_uint64),
+        ("rx_buf", ctypes.c_uint64),
+        ("len", ctypes.c_uint32),
+        ("speed_hz", ctypes.c_uint32),
+        ("delay_usecs", ctypes.c_uint16),
+        ("bits_per_word", ctypes.c_uint8),
+        ("cs_change", ctypes.c_uint8),
+        ("tx_nbits", ctypes.c_uint8),
+        ("rx_nbits", ctypes.c_uint8),
+        ("word_delay_usecs", ctypes.c_uint8),
+        ("pad", ctypes.c_uint8),
+    ]
+
+def _iow(nr, size):
+    return (1 << 30) | (size << 16) | (ord('k') << 8) | nr
+
+def spi_ioc_message(n):
+    return _iow(0, n * ctypes.sizeof(SpiIocTransfer))
+
+SPI_IOC_WR_MODE = _iow(1, 1)
+SPI_IOC_WR_MAX_SPEED_HZ = _iow(4, 4)
+SPI_IOC_MESSAGE_BURST = spi_ioc_message(ADC_CHANNELS)
+
+
+def open_spi_device(path):
+    """
+    Отваря spidev устройство и настройва mode и скорост.
+    """
+    fd = os.open(path, os.O_RDWR)
+    try:
+        fcntl.ioctl(fd, SPI_IOC_WR_MODE, struct.pack('B', SPI_MODE))
+        fcntl.ioctl(fd, SPI_IOC_WR_MAX_SPEED_HZ, struct.pack('I', SPI_SPEED_HZ))
+    except Exception:
+        os.close(fd)
+        raise
+    return fd
+
 
 class ADCManager:
     def __init__(self):
-        self.spi = None
+        self.spi_fd = None
         self.spi_available = False
+
+        # EMA стойности и коефициенти за всички канали
+        self.ema = np.zeros(ADC_CHANNELS, dtype=np.float32)
+        self.alpha = np.array([VOLTAGE_ALPHA] * 4 + [RESISTANCE_ALPHA] * 2, dtype=np.float32)
+        self.sample = np.zeros(ADC_CHANNELS, dtype=np.float32)
+        self.ema_initialized = False
+
+        # Директни референции към речниците на каналите в latest_data
+        self._ch_refs = [latest_data["adc_channels"][f"channel_{ch}"] for ch in range(ADC_CHANNELS)]
+
+        # Постоянни tx/rx буфери и SPI_IOC_MESSAGE за канали 0-5.
+        # MCP3008 започва нова конверсия само при смяна на CS, затова всеки
+        # канал е отделен transfer с cs_change, но всички минават с един ioctl.
+        self._tx = ctypes.create_string_buffer(
+            b''.join(bytes([1, (8 + ch) << 4, 0]) for ch in range(ADC_CHANNELS)),
+            ADC_CHANNELS * FRAME_SIZE)
+        self._rx = ctypes.create_string_buffer(ADC_CHANNELS * FRAME_SIZE)
+        # 10-битовите резултати са в байтове 1-2 на всяка рамка (big-endian);
+        # view директно върху rx буфера, без копиране
+        self._raw_view = np.ndarray(shape=(ADC_CHANNELS,), dtype='>u2', buffer=self._rx,
+                                    offset=1, strides=(FRAME_SIZE,))
+        self._raw_zero = np.zeros(ADC_CHANNELS, dtype=np.uint16)
+        self._xfers = (SpiIocTransfer * ADC_CHANNELS)()
+        for ch in range(ADC_CHANNELS):
+            xfer = self._xfers[ch]
+            xfer.tx_buf = ctypes.addressof(self._tx) + ch * FRAME_SIZE
+            xfer.rx_buf = ctypes.addressof(self._rx) + ch * FRAME_SIZE
+            xfer.len = FRAME_SIZE
+            xfer.speed_hz = SPI_SPEED_HZ
+            xfer.bits_per_word = 8
+            xfer.cs_change = 1 if ch < ADC_CHANNELS - 1 else 0
         
         # Try to open configured SPI bus/device first
         try:
-            self.spi = spidev.SpiDev()
-            self.spi.open(SPI_BUS, SPI_DEVICE)
-            self.spi.max_speed_hz = SPI_SPEED_HZ
-            self.spi.mode = SPI_MODE
+            self.spi_fd = open_spi_device(f"/dev/spidev{SPI_BUS}.{SPI_DEVICE}")
             self.spi_available = True
             logger.info(f"SPI interface initialized on /dev/spidev{SPI_BUS}.{SPI_DEVICE}")
         except Exception as e:
             logger.error(f"SPI initialization error on /dev/spidev{SPI_BUS}.{SPI_DEVICE}: {e}")
             
             # Auto-detect available SPI devices
-            import os
             try:
                 spi_devices = []
                 for dev_file in os.listdir('/dev'):
@@ -45,21 +126,12 @@ class ADCManager:
                     # Try each available device
                     for dev_file in sorted(spi_devices):
                         try:
-                            # Parse bus and device from spidevX.Y
-                            parts = dev_file.replace('spidev', '').split('.')
-                            if len(parts) == 2:
-                                bus = int(parts[0])
-                                device = int(parts[1])
-                                
-                                self.spi = spidev.SpiDev()
-                                self.spi.open(bus, device)
-                                self.spi.max_speed_hz = SPI_SPEED_HZ
-                                self.spi.mode = SPI_MODE
-                                self.spi_available = True
-                                logger.info(f"SPI auto-detected and initialized on /dev/{dev_file}")
-                                break
+                            self.spi_fd = open_spi_device(f"/dev/{dev_file}")
+                            self.spi_available = True
+                            logger.info(f"SPI auto-detected and initialized on /dev/{dev_file}")
+                            break
                         except Exception as e2:
-                            logger.debug(f"Failed to open /dev/{dev_file}: {e2}")
+                            logger.debug("Failed to open /dev/%s: %s", dev_file, e2)
                             continue
                 else:
                     logger.error("No /dev/spidev* devices found!")
@@ -70,82 +142,65 @@ class ADCManager:
         if not self.spi_available:
             logger.warning("ADC disabled - SPI not available")
 
-    def read_adc(self, channel):
+    def read_all_adc(self):
         """
-        Чете raw стойност от конкретен ADC канал (0-7) през MCP3008.
+        Чете raw стойности от канали 0-5 с един SPI_IOC_MESSAGE ioctl.
+        Връща numpy масив с 6 стойности (0-1023).
         """
-        if not self.spi_available or self.spi is None:
-            return 0
-        
-        if 0 <= channel <= 7:
-            cmd = [1, (8 + channel) << 4, 0]  # MCP3008 формат
-            try:
-                adc = self.spi.xfer2(cmd)
-                value = ((adc[1] & 3) << 8) + adc[2]
-                return value
-            except Exception as e:
-                logger.error(f"Error reading ADC channel {channel}: {e}")
-                return 0
-        else:
-            logger.warning(f"Invalid ADC channel: {channel}")
-            return 0
-
-    def calculate_voltage_from_raw(self, raw_value):
-        return (raw_value / ADC_RESOLUTION) * VREF * VOLTAGE_MULTIPLIER
+        if not self.spi_available or self.spi_fd is None:
+            return self._raw_zero
 
-    def calculate_resistance_from_raw(self, raw_value):
-        if raw_value == 0:
-            return 0.0
-        return ((RESISTANCE_REFERENCE * (ADC_RESOLUTION - raw_value)) / raw_value) / 10
+        try:
+            fcntl.ioctl(self.spi_fd, SPI_IOC_MESSAGE_BURST, self._xfers)
+            return self._raw_view & 0x3FF
+        except Exception as e:
+            logger.error(f"Error reading ADC channels: {e}")
+            return self._raw_zero
 
     def process_all_adc_channels(self):
         """
         Чете и филтрира всички канали (0-3 волтаж, 4-5 резист).
         Обновява latest_data.
         """
-        raw_values = [self.read_adc(ch) for ch in range(6)]
-
-        # Обработка на канали 0-3 (волтаж)
-        for ch in range(4):
-            voltage = self.calculate_voltage_from_raw(raw_values[ch])
-            voltage_buffers[ch].append(voltage)
-
-            # Moving Average (MA)
-            ma_voltage = sum(voltage_buffers[ch]) / len(voltage_buffers[ch])
-
-            # Exponential Moving Average (EMA)
-            alpha = 0.2
-            if ema_values[ch] is None:
-                ema_values[ch] = ma_voltage
-            else:
-                ema_values[ch] = alpha * ma_voltage + (1 - alpha) * ema_values[ch]
+        resolution = ADC_RESOLUTION
+        ema = self.ema
+        ch_refs = self._ch_refs
+
+        raw = self.read_all_adc().astype(np.float32)
+
+        # Канали 0-3 (волтаж) и 4-5 (резист) наведнъж
+        sample = self.sample
+        np.multiply(raw[:4], VOLTAGE_SCALE, out=sample[:4])
+        raw_r = raw[4:]
+        safe_r = np.where(raw_r > 0, raw_r, 1.0)
+        sample[4:] = np.where(raw_r > 0, RESISTANCE_REFERENCE * (resolution - raw_r) / safe_r / 10, 0.0)
+
+        # Exponential Moving Average (EMA)
+        if not self.ema_initialized:
+            ema[:] = sample
+            self.ema_initialized = True
+        else:
+            ema += self.alpha * (sample - ema)
 
-            # Минимален праг на напрежение
-            if ema_values[ch] < VOLTAGE_THRESHOLD:
-                ema_values[ch] = 0.0
+        # Минимален праг на напрежение
+        ema[:4] = np.where(ema[:4] < VOLTAGE_THRESHOLD, 0.0, ema[:4])
 
-            latest_data["adc_channels"][f"channel_{ch}"]["voltage"] = round(ema_values[ch], 2)
-            logger.debug(f"Channel {ch} Voltage: {latest_data['adc_channels'][f'channel_{ch}']['voltage']} V")
+        for ch in range(4):
+            ch_refs[ch]["voltage"] = float(ema[ch])
 
-        # Обработка на канали 4-5 (резист)
         for ch in range(4, 6):
-            resistance = self.calculate_resistance_from_raw(raw_values[ch])
-            resistance_buffers[ch].append(resistance)
-
-            # Moving Average (MA)
-            ma_resistance = sum(resistance_buffers[ch]) / len(resistance_buffers[ch])
-
-            alpha = 0.1
-            if ema_values[ch] is None:
-                ema_values[ch] = ma_resistance
-            else:
-                ema_values[ch] = alpha * ma_resistance + (1 - alpha) * ema_values[ch]
+            ch_refs[ch]["resistance"] = float(ema[ch])
 
-            latest_data["adc_channels"][f"channel_{ch}"]["resistance"] = round(ema_values[ch], 2)
-            logger.debug(f"Channel {ch} Resistance: {latest_data['adc_channels'][f'channel_{ch}']['resistance']} Ω")
+        if logger.isEnabledFor(logging.DEBUG):
+            for ch in range(4):
+                logger.debug("Channel %d Voltage: %.2f V", ch, ch_refs[ch]["voltage"])
+            for ch in range(4, 6):
+                logger.debug("Channel %d Resistance: %.2f Ω", ch, ch_refs[ch]["resistance"])
 
     def close(self):
         try:
-            self.spi.close()
+            if self.spi_fd is not None:
+                os.close(self.spi_fd)
+                self.spi_fd = None
         except Exception as e:
             logger.error(f"Error closing SPI: {e}")
@@ -1,38 +1,65 @@
 # can_communication.py
 
-import can
+import socket
+import struct
 import asyncio
+import logging
 from logger_config import logger
 from shared_data import latest_data
 
-def init_can_interface(channel='can0', bustype='socketcan'):
+# struct can_frame (linux/can.h): can_id, len, padding, data[8]
+CAN_FRAME_FMT = "=IB3x8s"
+CAN_FRAME_SIZE = struct.calcsize(CAN_FRAME_FMT)
+
+def init_can_interface(channel='can0'):
     """
-    Initializes the CAN interface using python-can.
+    Initializes a raw SocketCAN socket on the given channel.
     """
     try:
-        bus = can.interface.Bus(channel=channel, bustype=bustype)
-        logger.info(f"CAN interface initialized on channel {channel} with bustype {bustype}.")
-        return bus
+        sock = socket.socket(socket.AF_CAN, socket.SOCK_RAW, socket.CAN_RAW)
+        sock.bind((channel,))
+        sock.setblocking(False)
+        logger.info(f"CAN interface initialized on channel {channel} (raw SocketCAN).")
+        return sock
     except Exception as e:
         logger.error(f"CAN interface initialization error: {e}")
         return None
 
-async def can_listener(bus):
+async def can_listener(sock, timeout=1.0):
     """
     Asynchronously listens for CAN messages.
-    If a message is received, updates latest_data["can_status"] to "ON";
-    if no message is received within the timeout, sets it to "OFF".
+    The CAN socket is registered with the event loop, so the loop wakes only
+    when a frame arrives. If a message is received, updates
+    latest_data["can_status"] to "ON"; if no message is received within
+    `timeout` seconds, sets it to "OFF".
     """
-    while True:
+    loop = asyncio.get_running_loop()
+
+    def set_off():
+        latest_data["can_status"] = "OFF"
+
+    off_timer = loop.call_later(timeout, set_off)
+
+    def on_readable():
+        nonlocal off_timer
         try:
-            # Wait up to 1 second for a message in a separate thread
-            msg = await asyncio.to_thread(bus.recv, 1.0)
-            if msg:
-                logger.debug(f"Received CAN message: ID 0x{msg.arbitration_id:X}, data: {msg.data.hex()}")
-                latest_data["can_status"] = "ON"
-            else:
-                latest_data["can_status"] = "OFF"
+            frame = sock.recv(CAN_FRAME_SIZE)
+        except BlockingIOError:
+            return
         except Exception as e:
             logger.error(f"Error receiving CAN message: {e}")
-            latest_data["can_status"] = "OFF"
-        await asyncio.sleep(0.1)
+            return
+
+        if logger.isEnabledFor(logging.DEBUG):
+            can_id, length, data = struct.unpack(CAN_FRAME_FMT, frame)
+            logger.debug("Received CAN message: ID 0x%X, data: %s", can_id & socket.CAN_EFF_MASK, data[:length].hex())
+        latest_data["can_status"] = "ON"
+        off_timer.cancel()
+        off_timer = loop.call_later(timeout, set_off)
+
+    loop.add_reader(sock.fileno(), on_readable)
+    try:
+        await loop.create_future()
+    finally:
+        loop.remove_reader(sock.fileno())
+        off_timer.cancel()
@@ -25,6 +25,7 @@ ADC_INTERVAL = 0.1     # ADC readings every 0.1s
 LIN_INTERVAL = 2       # LIN communication every 2s
 MQTT_INTERVAL = 1      # MQTT publishing every 1s
 WS_INTERVAL = 1        # WebSocket broadcasting every 1s
+PWM_INTERVAL = 1       # PWM fan state/RPM update every 1s
 
 # Voltage Threshold to Eliminate Minor Noise
 VOLTAGE_THRESHOLD = 0.02  # Volts
@@ -34,6 +35,7 @@ VOLTAGE_THRESHOLD = 0.02  # Volts
 # ============================
 SYNC_BYTE = 0x55
 BREAK_DURATION = 1.35e-3  # 1.35 milliseconds
+FRAME_GAP = 0.01  # 10 ms inter-frame space between LIN requests
 
 PID_TEMPERATURE = 0x50
 PID_HUMIDITY = 0x51  # New PID for Humidity
@@ -66,6 +68,7 @@ PWM_PIN = 12           # BCM GPIO 12
 TACH_PIN = 13          # BCM GPIO 13
 PWM_FREQUENCY = int(os.getenv('PWM_FREQUENCY', '26000'))  # Read from HAOS config (default 26kHz)
 PULSES_PER_REV = 2     # Pulses per revolution from tachometer
+TACH_DEBOUNCE_US = 500  # Kernel-side edge debounce; < half a tach period at 12000 rpm
 
 # ============================
 # Supervisor & Ingress
@@ -7,9 +7,10 @@ import os
 import sys
 import json
 import logging
-from http.server import HTTPServer, BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 from urllib.parse import urlparse, parse_qs
 import threading
+import time
 
 logging.basicConfig(
     level=logging.INFO,
@@ -17,19 +18,59 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Готови стойности за sysfs enable атрибута
+ENABLE_ON, ENABLE_OFF = b"1", b"0"
+
+# Изчакване след export: до 50 x 10 ms
+EXPORT_POLL_TRIES = 50
+EXPORT_POLL_INTERVAL = 0.01
+
+# Фиксиран PWM chip (напр. PWM_CHIP=2 или pwmchip2) - без обхождане на /sys/class/pwm
+PWM_CHIP = os.getenv("PWM_CHIP")
+
+
+def is_valid_frequency(value):
+    """Честотата трябва да е положително цяло число (bool не се приема)"""
+    return isinstance(value, int) and not isinstance(value, bool) and value > 0
+
 
 class PWMController:
     """Hardware PWM контролер чрез sysfs"""
     
     def __init__(self):
         self.pwm_instances = {}  # {gpio_pin: PWMInstance}
+        self.pwm_fds = {}  # {gpio_pin: {attr: fd}} - отворени sysfs атрибути
+        self.duty_lut = {}  # {gpio_pin: [b"duty_ns" за 0..100%]}
+        self._chip_cache = {}  # {channel: pwm_chip} - chip-овете не се сменят до reboot
         self.lock = threading.Lock()
     
-    def _find_pwm_chip(self):
-        """Намери наличен PWM chip"""
-        for chip in ["pwmchip0", "pwmchip2", "pwmchip3"]:
-            path = f"/sys/class/pwm/{chip}"
-            if os.path.exists(path):
+    def _find_pwm_chip(self, channel=0):
+        """Намери hardware PWM chip, който има нужния channel (кеширано след първото намиране)"""
+        chip = self._chip_cache.get(channel)
+        if chip is None:
+            if PWM_CHIP:
+                chip = PWM_CHIP if PWM_CHIP.startswith("pwmchip") else f"pwmchip{PWM_CHIP}"
+                if not os.path.isdir(f"/sys/class/pwm/{chip}"):
+                    logger.error(f"PWM_CHIP={PWM_CHIP}: /sys/class/pwm/{chip} не съществува")
+                    return None
+            else:
+                chip = self._probe_pwm_chip(channel)
+            if chip is not None:
+                self._chip_cache[channel] = chip
+        return chip
+    
+    def _probe_pwm_chip(self, channel):
+        """Обходи /sys/class/pwm за chip с поне channel+1 канала"""
+        preferred = ["pwmchip0", "pwmchip2", "pwmchip3"]
+        try:
+            others = sorted((c for c in os.listdir("/sys/class/pwm")
+                             if c.startswith("pwmchip") and c not in preferred),
+                            key=lambda c: int(c[7:]) if c[7:].isdigit() else 0)
+        except OSError:
+            return None
+        for chip in preferred + others:
+            npwm = self._read_file(f"/sys/class/pwm/{chip}/npwm")
+            if npwm is not None and npwm.isdigit() and int(npwm) > channel:
                 return chip
         return None
     
@@ -39,16 +80,37 @@ class PWMController:
             with open(path, 'w') as f:
                 f.write(str(value))
             return True
-        except Exception as e:
+        except OSError as e:
             logger.error(f"Error writing to {path}: {e}")
             return False
     
+    def _open_attr(self, path):
+        """Отвори sysfs атрибут за запис и върни fd"""
+        return os.open(path, os.O_WRONLY | os.O_CLOEXEC)
+    
+    def _write_fd(self, fd, data):
+        """Запиши готови байтове в отворен sysfs атрибут"""
+        try:
+            os.pwrite(fd, data, 0)
+            return True
+        except OSError as e:
+            logger.error(f"Error writing to fd {fd}: {e}")
+            return False
+    
+    def _close_fds(self, fds):
+        """Затвори fd-тата на sysfs атрибутите"""
+        for fd in fds.values():
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+    
     def _read_file(self, path):
         """Прочети стойност от файл"""
         try:
             with open(path, 'r') as f:
                 return f.read().strip()
-        except Exception as e:
+        except OSError:
             return None
     
     def initialize_pwm(self, gpio_pin, frequency):
@@ -56,40 +118,58 @@ class PWMController:
         with self.lock:
             if gpio_pin in self.pwm_instances:
                 logger.info(f"PWM на GPIO{gpio_pin} вече е инициализиран")
+                if self.pwm_instances[gpio_pin]["frequency"] != frequency:
+                    return self._apply_frequency(gpio_pin, frequency)
                 return True
             
             try:
-                pwm_chip = self._find_pwm_chip()
-                if not pwm_chip:
-                    logger.error("PWM chip не е намерен")
-                    return False
-                
                 # Определи PWM channel (0 за GPIO12/18, 1 за GPIO13/19)
                 channel = 0 if gpio_pin in [12, 18] else 1
+                
+                pwm_chip = self._find_pwm_chip(channel)
+                if not pwm_chip:
+                    logger.error(f"Hardware PWM chip с channel {channel} не е намерен")
+                    return False
                 pwm_path = f"/sys/class/pwm/{pwm_chip}/pwm{channel}"
                 
                 # Export ако не е експортиран
                 if not os.path.exists(pwm_path):
                     export_path = f"/sys/class/pwm/{pwm_chip}/export"
                     self._write_file(export_path, str(channel))
-                    import time
-                    time.sleep(0.5)
                 
-                if not os.path.exists(pwm_path):
+                # Изчакай kernel-а да създаде атрибутите (обикновено < 10 ms)
+                period_attr = f"{pwm_path}/period"
+                for _ in range(EXPORT_POLL_TRIES):
+                    if os.path.exists(period_attr):
+                        break
+                    time.sleep(EXPORT_POLL_INTERVAL)
+                else:
                     logger.error(f"PWM path {pwm_path} не съществува")
                     return False
                 
                 # Изчисли период
                 period_ns = int(1e9 / frequency)
                 
+                # Отвори атрибутите веднъж; следващите записи са само pwrite на offset 0
+                fds = {}
+                try:
+                    for attr in ("period", "duty_cycle", "enable"):
+                        fds[attr] = self._open_attr(f"{pwm_path}/{attr}")
+                except OSError as e:
+                    self._close_fds(fds)
+                    logger.error(f"Cannot open PWM attributes in {pwm_path}: {e}")
+                    return False
+                
                 # Настрой период
-                period_path = f"{pwm_path}/period"
-                if not self._write_file(period_path, str(period_ns)):
+                if not self._write_fd(fds["period"], str(period_ns).encode()):
+                    self._close_fds(fds)
                     return False
                 
+                # duty_ns за всеки цял процент, готов за запис в sysfs
+                duty_lut = [str(period_ns * i // 100).encode() for i in range(101)]
+                
                 # Настрой duty cycle на 0
-                duty_path = f"{pwm_path}/duty_cycle"
-                self._write_file(duty_path, "0")
+                self._write_fd(fds["duty_cycle"], duty_lut[0])
                 
                 # Запази информация
                 self.pwm_instances[gpio_pin] = {
@@ -101,6 +181,8 @@ class PWMController:
                     "duty_cycle": 0,
                     "enabled": False
                 }
+                self.pwm_fds[gpio_pin] = fds
+                self.duty_lut[gpio_pin] = duty_lut
                 
                 logger.info(f"✓ PWM инициализиран: GPIO{gpio_pin}, {frequency}Hz")
                 return True
@@ -119,19 +201,74 @@ class PWMController:
             try:
                 instance = self.pwm_instances[gpio_pin]
                 duty_cycle = max(0, min(100, duty_cycle))
-                duty_ns = int(instance["period_ns"] * duty_cycle / 100)
-                
-                duty_path = f"{instance['pwm_path']}/duty_cycle"
-                if self._write_file(duty_path, str(duty_ns)):
-                    instance["duty_cycle"] = duty_cycle
-                    logger.info(f"PWM GPIO{gpio_pin}: duty cycle = {duty_cycle}%")
+                if duty_cycle == instance["duty_cycle"]:
+                    # Вече е записан - без sysfs запис
                     return True
-                return False
+                if duty_cycle == int(duty_cycle):
+                    duty_bytes = self.duty_lut[gpio_pin][int(duty_cycle)]
+                else:
+                    # Дробен процент - изчисли точно
+                    duty_bytes = str(int(instance["period_ns"] * duty_cycle / 100)).encode()
                 
+                # Най-честият запис - директно в отворения duty_cycle атрибут
+                os.pwrite(self.pwm_fds[gpio_pin]["duty_cycle"], duty_bytes, 0)
+                instance["duty_cycle"] = duty_cycle
+                logger.info("PWM GPIO%s: duty cycle = %s%%", gpio_pin, duty_cycle)
+                return True
+                
+            except OSError as e:
+                logger.error(f"Error writing duty_cycle for GPIO{gpio_pin}: {e}")
+                return False
             except Exception as e:
                 logger.error(f"Грешка при настройка на duty cycle: {e}")
                 return False
     
+    def set_frequency(self, gpio_pin, frequency):
+        """Смени честотата, като запазва duty cycle в проценти"""
+        with self.lock:
+            if gpio_pin not in self.pwm_instances:
+                logger.error(f"PWM на GPIO{gpio_pin} не е инициализиран")
+                return False
+            return self._apply_frequency(gpio_pin, frequency)
+    
+    def _apply_frequency(self, gpio_pin, frequency):
+        """Запиши нов period и мащабиран duty (извиква се с взет self.lock)"""
+        instance = self.pwm_instances[gpio_pin]
+        fds = self.pwm_fds[gpio_pin]
+        try:
+            period_ns = int(1e9 / frequency)
+            duty_lut = [str(period_ns * i // 100).encode() for i in range(101)]
+            duty_cycle = instance["duty_cycle"]
+            if duty_cycle == int(duty_cycle):
+                duty_bytes = duty_lut[int(duty_cycle)]
+            else:
+                duty_bytes = str(int(period_ns * duty_cycle / 100)).encode()
+            
+            # Kernel-ът изисква duty_cycle <= period след всеки запис:
+            # при по-къс период първо duty, при по-дълъг - първо period
+            if instance["enabled"]:
+                os.pwrite(fds["enable"], ENABLE_OFF, 0)
+            try:
+                if period_ns < instance["period_ns"]:
+                    os.pwrite(fds["duty_cycle"], duty_bytes, 0)
+                    os.pwrite(fds["period"], str(period_ns).encode(), 0)
+                else:
+                    os.pwrite(fds["period"], str(period_ns).encode(), 0)
+                    os.pwrite(fds["duty_cycle"], duty_bytes, 0)
+            finally:
+                # И при отказан запис изходът остава включен, както е в instance
+                if instance["enabled"]:
+                    self._write_fd(fds["enable"], ENABLE_ON)
+            
+            instance["frequency"] = frequency
+            instance["period_ns"] = period_ns
+            self.duty_lut[gpio_pin] = duty_lut
+            logger.info(f"PWM GPIO{gpio_pin}: frequency = {frequency}Hz, duty cycle = {duty_cycle}%")
+            return True
+        except (OSError, TypeError, ValueError, ZeroDivisionError) as e:
+            logger.error(f"Грешка при смяна на честотата: {e}")
+            return False
+    
     def enable_pwm(self, gpio_pin):
         """Включи PWM"""
         with self.lock:
@@ -140,8 +277,7 @@ class PWMController:
             
             try:
                 instance = self.pwm_instances[gpio_pin]
-                enable_path = f"{instance['pwm_path']}/enable"
-                if self._write_file(enable_path, "1"):
+                if self._write_fd(self.pwm_fds[gpio_pin]["enable"], ENABLE_ON):
                     instance["enabled"] = True
                     logger.info(f"✓ PWM GPIO{gpio_pin} включен")
                     return True
@@ -158,8 +294,7 @@ class PWMController:
             
             try:
                 instance = self.pwm_instances[gpio_pin]
-                enable_path = f"{instance['pwm_path']}/enable"
-                if self._write_file(enable_path, "0"):
+                if self._write_fd(self.pwm_fds[gpio_pin]["enable"], ENABLE_OFF):
                     instance["enabled"] = False
                     logger.info(f"✓ PWM GPIO{gpio_pin} изключен")
                     return True
@@ -168,6 +303,14 @@ class PWMController:
                 logger.error(f"Грешка при изключване на PWM: {e}")
                 return False
     
+    def close(self):
+        """Затвори отворените sysfs атрибути"""
+        with self.lock:
+            for fds in self.pwm_fds.values():
+                self._close_fds(fds)
+            self.pwm_fds.clear()
+            self.duty_lut.clear()
+    
     def get_status(self, gpio_pin=None):
         """Вземи статус на PWM"""
         with self.lock:
@@ -179,13 +322,18 @@ class PWMController:
 class PWMRequestHandler(BaseHTTPRequestHandler):
     """HTTP Request Handler за PWM API"""
     
+    # HTTP/1.1 keep-alive: add-on-ът праща всички заявки по една връзка
+    protocol_version = "HTTP/1.1"
+    
     def _send_json_response(self, status_code, data):
         """Изпрати JSON отговор"""
+        body = json.dumps(data).encode()
         self.send_response(status_code)
         self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
         self.send_header('Access-Control-Allow-Origin', '*')
         self.end_headers()
-        self.wfile.write(json.dumps(data).encode())
+        self.wfile.write(body)
     
     def do_GET(self):
         """Handle GET requests"""
@@ -231,6 +379,9 @@ class PWMRequestHandler(BaseHTTPRequestHandler):
             if gpio_pin is None:
                 self._send_json_response(400, {"status": "error", "message": "gpio_pin required"})
                 return
+            if not is_valid_frequency(frequency):
+                self._send_json_response(400, {"status": "error", "message": "frequency must be a positive integer"})
+                return
             
             success = self.server.pwm_controller.initialize_pwm(gpio_pin, frequency)
             if success:
@@ -253,6 +404,24 @@ class PWMRequestHandler(BaseHTTPRequestHandler):
             else:
                 self._send_json_response(500, {"status": "error", "message": "Failed to set duty cycle"})
         
+        elif parsed.path == '/frequency':
+            # Смяна на честотата (duty cycle се запазва)
+            gpio_pin = data.get('gpio_pin')
+            frequency = data.get('frequency')
+            
+            if gpio_pin is None or frequency is None:
+                self._send_json_response(400, {"status": "error", "message": "gpio_pin and frequency required"})
+                return
+            if not is_valid_frequency(frequency):
+                self._send_json_response(400, {"status": "error", "message": "frequency must be a positive integer"})
+                return
+            
+            success = self.server.pwm_controller.set_frequency(gpio_pin, frequency)
+            if success:
+                self._send_json_response(200, {"status": "ok", "message": "Frequency set"})
+            else:
+                self._send_json_response(500, {"status": "error", "message": "Failed to set frequency"})
+        
         elif parsed.path == '/enable':
             # Включване на PWM
             gpio_pin = data.get('gpio_pin')
@@ -309,13 +478,16 @@ def main():
     pwm_controller = PWMController()
     
     # Създай HTTP сървър
-    server = HTTPServer((HOST, PORT), PWMRequestHandler)
+    # Нишка на връзка, за да не блокира една keep-alive връзка останалите клиенти
+    server = ThreadingHTTPServer((HOST, PORT), PWMRequestHandler)
+    server.daemon_threads = True
     server.pwm_controller = pwm_controller
     
     logger.info(f"✓ PWM Daemon стартиран на {HOST}:{PORT}")
     logger.info("API endpoints:")
     logger.info("  POST /init        - Инициализация на PWM")
     logger.info("  POST /duty        - Настройка на duty cycle")
+    logger.info("  POST /frequency   - Смяна на честотата")
     logger.info("  POST /enable      - Включване на PWM")
     logger.info("  POST /disable     - Изключване на PWM")
     logger.info("  GET  /status      - Статус на всички PWM")
@@ -327,6 +499,8 @@ def main():
     except KeyboardInterrupt:
         logger.info("\nSpиране на daemon...")
         server.shutdown()
+    finally:
+        pwm_controller.close()
 
 
 if __name__ == "__main__":
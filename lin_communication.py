@@ -6,18 +6,24 @@ import asyncio
 import logging
 from logger_config import logger
 from config import (
-    SYNC_BYTE, BREAK_DURATION, PID_DICT,
+    SYNC_BYTE, BREAK_DURATION, FRAME_GAP, PID_DICT,
     UART_PORT, UART_BAUDRATE
 )
 from shared_data import latest_data
 
+# Skipped noise kept in the receive buffer before it is compacted
+MAX_SKIPPED_BYTES = 4096
+
+# (PID, sensor name) pairs polled on every LIN cycle
+_PIDS = tuple(PID_DICT.items())
+
 
 def enhanced_checksum(data):
     """
     Calculates checksum by summing all bytes and returning its inversion.
+    `data` is a bytes-like object (PID followed by the data bytes).
     """
-    checksum = sum(data) & 0xFF
-    return (~checksum) & 0xFF
+    return (~sum(data)) & 0xFF
 
 
 class LinCommunication:
@@ -43,9 +49,12 @@ class LinCommunication:
         except Exception as e:
             logger.error(f"Error sending BREAK: {e}")
 
-    def send_header(self, pid):
+    def send_header(self, pid, name='Unknown'):
         """
         Sends SYNC + PID to the slave and clears the UART buffer.
+        A plain call: only the ~1.35 ms BREAK timing blocks. There is no
+        pause afterwards, the reply is buffered by the UART until
+        read_response picks it up.
         """
         try:
             self.ser.reset_input_buffer()
@@ -53,8 +62,7 @@ class LinCommunication:
             self.send_break()
             header = bytes([SYNC_BYTE, pid])
             self.ser.write(header)
-            logger.debug(f"Header sent: SYNC=0x{SYNC_BYTE:02X}, PID=0x{pid:02X} ({PID_DICT.get(pid, 'Unknown')})")
-            time.sleep(0.1)  # Short pause for slave to process
+            logger.debug("Header sent: SYNC=0x%02X, PID=0x%02X (%s)", SYNC_BYTE, pid, name)
         except Exception as e:
             logger.error(f"Error sending header: {e}")
 
@@ -62,42 +70,73 @@ class LinCommunication:
         """
         Reads response from the slave, ignoring echoed bytes.
         Expects `expected_data_length` bytes after [SYNC_BYTE, PID].
+        The UART fd is registered with the event loop, so bytes are consumed
+        as soon as they arrive instead of polling `in_waiting`.
         """
+        loop = asyncio.get_running_loop()
+        buffer = bytearray()
+        head = 0  # Offset of the candidate frame start in buffer
+        sync_pid = bytes([SYNC_BYTE, pid])
+        response_ready = loop.create_future()
+
+        def on_readable():
+            nonlocal head
+            try:
+                data = self.ser.read(self.ser.in_waiting or 1)
+            except Exception as e:
+                if not response_ready.done():
+                    response_ready.set_exception(e)
+                return
+            if response_ready.done():
+                return
+            buffer.extend(data)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Received bytes: %s", data.hex())
+
+            # Search for [SYNC_BYTE, PID] from the current frame start
+            sync_pid_index = buffer.find(sync_pid, head)
+            if sync_pid_index == -1:
+                # Keep only the last byte, it may be the start of SYNC + PID
+                head = max(head, len(buffer) - 1)
+            else:
+                # Skip bytes before [SYNC_BYTE, PID]
+                if sync_pid_index > head:
+                    logger.debug("Skipping %d bytes before SYNC + PID.", sync_pid_index - head)
+                    head = sync_pid_index
+
+                # Check if there are enough bytes after [SYNC_BYTE, PID]
+                start = head + 2
+                if len(buffer) >= start + expected_data_length:
+                    response = bytes(buffer[start:start + expected_data_length])
+                    if logger.isEnabledFor(logging.DEBUG):
+                        logger.debug("Extracted Response: %s", response.hex())
+                    response_ready.set_result(response)
+                    return
+
+            # Compact the buffer only once the skipped prefix grows large
+            if head > MAX_SKIPPED_BYTES:
+                del buffer[:head]
+                head = 0
+
         try:
-            start_time = time.time()
-            buffer = bytearray()
-
-            while (time.time() - start_time) < 2.0:  # 2-second timeout
-                if self.ser.in_waiting > 0:
-                    # Read available bytes in a separate thread
-                    data = await asyncio.to_thread(self.ser.read, self.ser.in_waiting)
-                    buffer.extend(data)
-                    logger.debug(f"Received bytes: {data.hex()}")
-
-                    # Search for [SYNC_BYTE, PID] in the buffer
-                    sync_pid_index = buffer.find(bytes([SYNC_BYTE, pid]))
-                    if sync_pid_index != -1:
-                        # Remove bytes before [SYNC_BYTE, PID]
-                        if sync_pid_index > 0:
-                            logger.debug(f"Skipping {sync_pid_index} bytes before SYNC + PID.")
-                            buffer = buffer[sync_pid_index:]
-
-                        # Check if there are enough bytes after [SYNC_BYTE, PID]
-                        if len(buffer) >= 2 + expected_data_length:
-                            # Remove [SYNC_BYTE, PID]
-                            buffer = buffer[2:]
-                            response = buffer[:expected_data_length]
-                            logger.debug(f"Extracted Response: {response.hex()}")
-                            return response
-                else:
-                    await asyncio.sleep(0.01)  # Short pause before next check
+            fd = self.ser.fileno()
+            loop.add_reader(fd, on_readable)
+        except Exception as e:
+            logger.error(f"Error reading response: {e}")
+            return None
+
+        try:
+            return await asyncio.wait_for(response_ready, 2.0)  # 2-second timeout
+        except asyncio.TimeoutError:
             logger.warning("No valid response received within timeout.")
             return None
         except Exception as e:
             logger.error(f"Error reading response: {e}")
             return None
+        finally:
+            loop.remove_reader(fd)
 
-    def process_response(self, response, pid):
+    def process_response(self, response, pid, sensor='Unknown'):
         """
         Validates checksum and updates latest_data.
         """
@@ -105,18 +144,17 @@ class LinCommunication:
             if response and len(response) == 3:
                 data = response[:2]
                 received_checksum = response[2]
-                calculated_checksum = enhanced_checksum([pid] + list(data))
-                logger.debug(f"Received Checksum: 0x{received_checksum:02X}, Calculated Checksum: 0x{calculated_checksum:02X}")
+                calculated_checksum = enhanced_checksum(bytes((pid,)) + data)
+                logger.debug("Received Checksum: 0x%02X, Calculated Checksum: 0x%02X", received_checksum, calculated_checksum)
 
                 if received_checksum == calculated_checksum:
                     value = int.from_bytes(data, 'little') / 100.0
-                    sensor = PID_DICT.get(pid, 'Unknown')
                     if sensor == 'Temperature':
                         latest_data["slave_sensors"]["slave_1"]["Temperature"] = value
-                        logger.debug(f"Updated Temperature: {value:.2f}°C")
+                        logger.debug("Updated Temperature: %.2f°C", value)
                     elif sensor == 'Humidity':
                         latest_data["slave_sensors"]["slave_1"]["Humidity"] = value
-                        logger.debug(f"Updated Humidity: {value:.2f}%")
+                        logger.debug("Updated Humidity: %.2f%%", value)
                     else:
                         logger.warning(f"Unknown PID {pid}: Value={value}")
                 else:
@@ -130,15 +168,15 @@ class LinCommunication:
         """
         Asynchronously sends LIN requests and processes responses.
         """
-        for pid in PID_DICT.keys():
-            logger.debug(f"Processing PID: 0x{pid:02X}")
-            self.send_header(pid)
+        for pid, name in _PIDS:
+            logger.debug("Processing PID: 0x%02X", pid)
+            self.send_header(pid, name)
             response = await self.read_response(3, pid)  # 3 bytes: 2 data + 1 checksum
             if response:
-                self.process_response(response, pid)
+                self.process_response(response, pid, name)
             else:
                 logger.warning(f"No response for PID 0x{pid:02X}")
-            await asyncio.sleep(0.1)  # Short pause between requests
+            await asyncio.sleep(FRAME_GAP)  # Inter-frame space before the next header
 
     def close(self):
         """
@@ -1,16 +1,47 @@
 # mqtt_manager.py
 
-import threading
-import json
+import socket
+import orjson
 import paho.mqtt.client as mqtt
-import logging
 
 from logger_config import logger
 from config import (
     MQTT_BROKER, MQTT_PORT, MQTT_USERNAME, MQTT_PASSWORD, 
     MQTT_DISCOVERY_PREFIX, MQTT_CLIENT_ID
 )
-from shared_data import latest_data
+from shared_data import latest_data, quantize_adc
+
+# Pre-encoded static payloads
+B_ON, B_OFF = b"ON", b"OFF"
+B_ONLINE, B_OFFLINE = b"online", b"offline"
+
+# Telemetry, state and discovery are fire-and-forget; QoS 1/2 would only add round-trips
+QOS = 0
+
+# Socket send buffer, comfortably above one full discovery burst (~5 KB)
+MQTT_SNDBUF = 64 * 1024
+
+# All telemetry is published as one JSON document per tick
+STATE_TOPIC = "cis3/state"
+
+# Home Assistant's birth/last-will topic ("online" after every HA start)
+HA_STATUS_TOPIC = f"{MQTT_DISCOVERY_PREFIX}/status"
+
+# Home Assistant device block, shared by every discovery config
+DEVICE_INFO = {
+    "identifiers": ["cis3_device"],
+    "name": "CIS3 Device",
+    "model": "CIS3 PCB V3.0",
+    "manufacturer": "biCOMM Design Ltd"
+}
+
+# Keys common to every discovery config; each entity overlays its own fields
+DISCOVERY_BASE = {
+    "availability_topic": "cis3/status",
+    "payload_available": "online",
+    "payload_not_available": "offline",
+    "device": DEVICE_INFO
+}
 
 class MqttManager:
     def __init__(self):
@@ -19,257 +50,266 @@ class MqttManager:
         self.client.on_connect = self.on_connect
         self.client.on_disconnect = self.on_disconnect
         self.client.on_message = self.on_message
+        # Broker publishes "offline" for us if the connection drops uncleanly
+        self.client.will_set("cis3/status", payload=B_OFFLINE, qos=QOS, retain=True)
+        # Room for the whole discovery burst plus regular telemetry
+        self.client.max_inflight_messages_set(100)
+        self.client.max_queued_messages_set(200)
+        # Exponential backoff between reconnect attempts, driven by loop_forever
+        self.client.reconnect_delay_set(min_delay=1, max_delay=60)
+        # Discovery payloads are static, build them once
+        self._discovery_msgs = self._build_discovery_msgs()
+        # Last payload published per topic, used to skip unchanged values
+        self._last_pub = {}
+        # Sub-dicts of latest_data are updated in place, resolve them once
+        self._adc = latest_data["adc_channels"]
+        self._slave = latest_data["slave_sensors"]["slave_1"]
+        self._fan = latest_data["pwm_fan"]
+        # Command topic -> handler, also the list of topics to subscribe to
+        self._handlers = {
+            "cis3/fan/enable/set": self._handle_fan_enable,
+            "cis3/fan/duty/set": self._handle_fan_duty,
+            HA_STATUS_TOPIC: self._handle_ha_status
+        }
 
     def on_connect(self, client, userdata, flags, rc):
         if rc == 0:
             logger.info("Connected to MQTT Broker.")
-            client.publish("cis3/status", "online", retain=True)
-            # Subscribe to PWM fan command topics
-            client.subscribe("cis3/fan/enable/set")
-            client.subscribe("cis3/fan/duty/set")
+            self._tune_socket(client.socket())
+            # Fresh session: the broker may have lost state, republish everything
+            self._last_pub.clear()
+            client.publish("cis3/status", B_ONLINE, qos=QOS, retain=True)
+            # Subscribe to PWM fan command topics and Home Assistant's status
+            client.subscribe([(topic, QOS) for topic in self._handlers])
             self.publish_mqtt_discovery()
+            # Flush the queued discovery burst now instead of on the next loop iteration
+            client.loop_write()
         else:
             logger.error(f"Failed to connect to MQTT Broker, return code {rc}")
 
+    def _tune_socket(self, sock):
+        """
+        Disables Nagle so small PUBLISH packets are sent without delay, and
+        sizes the send buffer so the whole discovery burst fits in it.
+        Called on every (re)connect, since paho opens a new socket each time.
+        """
+        if sock is None:
+            return
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, MQTT_SNDBUF)
+        except OSError as e:
+            logger.warning(f"Could not tune MQTT socket: {e}")
+
     def on_disconnect(self, client, userdata, rc):
         if rc != 0:
-            logger.warning("Unexpected MQTT disconnection. Attempting to reconnect.")
-            try:
-                client.reconnect()
-            except Exception as e:
-                logger.error(f"Reconnection failed: {e}")
+            # loop_forever reconnects on its own, with the backoff set in __init__
+            logger.warning("Unexpected MQTT disconnection. Reconnecting in the background.")
 
     def on_message(self, client, userdata, msg):
         try:
-            topic = msg.topic
-            payload = msg.payload.decode().strip()
-            if topic == "cis3/fan/enable/set":
-                enabled = payload.upper() == "ON"
-                latest_data["pwm_fan"]["enabled"] = enabled
-                # Echo state
-                self.client.publish("cis3/fan/enable/state", "ON" if enabled else "OFF", retain=True)
-                logger.info(f"PWM fan enable set via MQTT: {enabled}")
-            elif topic == "cis3/fan/duty/set":
-                try:
-                    duty = int(payload)
-                except ValueError:
-                    logger.warning(f"Ignoring non-integer duty payload: {payload}")
-                    return
-                duty = max(10, min(100, duty))
-                latest_data["pwm_fan"]["duty_cycle"] = duty
-                # Echo state
-                self.client.publish("cis3/fan/duty/state", str(duty), retain=True)
-                logger.info(f"PWM fan duty set via MQTT: {duty}%")
+            handler = self._handlers.get(msg.topic)
+            if handler:
+                handler(msg.payload.decode().strip())
         except Exception as e:
             logger.error(f"Error in MQTT on_message: {e}")
 
-    def mqtt_loop(self):
+    def _handle_fan_enable(self, payload):
+        enabled = payload.upper() == "ON"
+        self._fan["enabled"] = enabled
+        # Echo state
+        self.publish_many([("cis3/fan/enable/state", B_ON if enabled else B_OFF, QOS, True)])
+        logger.info(f"PWM fan enable set via MQTT: {enabled}")
+
+    def _handle_fan_duty(self, payload):
         try:
-            self.client.connect(MQTT_BROKER, MQTT_PORT, keepalive=60)
-            self.client.loop_forever()
-        except Exception as e:
-            logger.error(f"MQTT loop error: {e}")
+            duty = int(payload)
+        except ValueError:
+            logger.warning(f"Ignoring non-integer duty payload: {payload}")
+            return
+        duty = max(10, min(100, duty))
+        self._fan["duty_cycle"] = duty
+        # Echo state
+        self.publish_many([("cis3/fan/duty/state", b"%d" % duty, QOS, True)])
+        logger.info(f"PWM fan duty set via MQTT: {duty}%")
+
+    def _handle_ha_status(self, payload):
+        if payload == "online":
+            # HA restarted and lost the non-retained state: resend everything
+            # on the next tick instead of waiting for a value to change
+            self._last_pub.clear()
+            logger.info("Home Assistant online, state will be republished")
 
     def start(self):
-        thread = threading.Thread(target=self.mqtt_loop, daemon=True)
-        thread.start()
+        """
+        Starts paho's network thread. connect_async returns at once, and the
+        managed loop keeps retrying (including the first connection) with
+        the backoff set in __init__.
+        """
+        try:
+            self.client.connect_async(MQTT_BROKER, MQTT_PORT, keepalive=60)
+            self.client.loop_start()
+        except Exception as e:
+            logger.error(f"MQTT start error: {e}")
+
+    def stop(self):
+        # A clean DISCONNECT discards the will, so announce "offline" explicitly
+        self.client.publish("cis3/status", B_OFFLINE, qos=QOS, retain=True)
+        self.client.disconnect()
+        self.client.loop_stop()
+
+    def publish_many(self, msgs):
+        """
+        Publishes a batch of (topic, payload, qos, retain) messages in one pass.
+        Messages whose payload equals the last one sent on that topic are skipped.
+        Each PUBLISH still goes out on its own: paho's writer sends queued
+        packets one by one, and calling loop_write() here would race the
+        loop_start() thread. The per-tick telemetry is batched at the payload
+        level instead, as the single STATE_TOPIC document.
+        """
+        publish = self.client.publish
+        last_pub = self._last_pub
+        for topic, payload, qos, retain in msgs:
+            if last_pub.get(topic) == payload:
+                continue
+            last_pub[topic] = payload
+            publish(topic, payload, qos=qos, retain=retain)
 
     def publish_to_mqtt(self):
         try:
-            # Publish ADC Channels
-            for i in range(6):
-                channel = f"channel_{i}"
-                if i < 4:
-                    state_topic = f"cis3/{channel}/voltage"
-                    payload = latest_data["adc_channels"][channel]["voltage"]
-                    self.client.publish(state_topic, str(payload))
-                    logger.debug(f"Published {channel} Voltage: {payload} V to {state_topic}")
-                else:
-                    state_topic = f"cis3/{channel}/resistance"
-                    payload = latest_data["adc_channels"][channel]["resistance"]
-                    self.client.publish(state_topic, str(payload))
-                    logger.debug(f"Published {channel} Resistance: {payload} Ω to {state_topic}")
-
-            # Publish Slave Sensor Data
-            slave = latest_data["slave_sensors"]["slave_1"]
-            for sensor, value in slave.items():
-                state_topic = f"cis3/slave_1/{sensor.lower()}"
-                self.client.publish(state_topic, str(value))
-                logger.debug(f"Published Slave_1 {sensor}: {value} to {state_topic}")
-
-            # Publish CAN status
-            can_status = latest_data.get("can_status", "OFF")
-            state_topic = "cis3/can/status"
-            self.client.publish(state_topic, can_status)
-            logger.debug(f"Published CAN status: {can_status} to {state_topic}")
-
-            # Publish PWM fan state
-            fan = latest_data.get("pwm_fan", {})
-            self.client.publish("cis3/fan/enable/state", "ON" if fan.get("enabled") else "OFF", retain=True)
-            self.client.publish("cis3/fan/duty/state", str(fan.get("duty_cycle", 10)), retain=True)
-            self.client.publish("cis3/fan/rpm", str(fan.get("rpm", 0)))
-            logger.debug(f"Published PWM fan: enabled={fan.get('enabled')} duty={fan.get('duty_cycle')} rpm={fan.get('rpm')}")
+            adc = self._adc
+            fan = self._fan
+
+            # ADC, slave sensors, CAN and fan telemetry in a single message
+            state = {
+                "adc": quantize_adc(adc),
+                "slave_1": self._slave,
+                "can": latest_data.get("can_status", "OFF"),
+                "fan": fan
+            }
+            msgs = [(STATE_TOPIC, orjson.dumps(state), QOS, False)]
+            logger.debug("Published state to %s", STATE_TOPIC)
+
+            # PWM fan switch/number state (retained, read by the HA entities)
+            msgs.append(("cis3/fan/enable/state", B_ON if fan.get("enabled") else B_OFF, QOS, True))
+            msgs.append(("cis3/fan/duty/state", b"%d" % fan.get("duty_cycle", 10), QOS, True))
+            logger.debug("Published PWM fan: enabled=%s duty=%s rpm=%s", fan.get('enabled'), fan.get('duty_cycle'), fan.get('rpm'))
+
+            self.publish_many(msgs)
         except Exception as e:
             logger.error(f"Error publishing to MQTT: {e}")
 
-    def publish_mqtt_discovery(self):
-        try:
-            # MQTT Discovery for ADC Channels
-            for i in range(6):
-                channel = f"channel_{i}"
-                if i < 4:
-                    sensor = {
-                        "name": f"CIS3 Channel {i} Voltage",
-                        "unique_id": f"cis3_{channel}_voltage",
-                        "state_topic": f"cis3/{channel}/voltage",
-                        "unit_of_measurement": "V",
-                        "device_class": "voltage",
-                        "icon": "mdi:flash",
-                        "value_template": "{{ value }}",
-                        "availability_topic": "cis3/status",
-                        "payload_available": "online",
-                        "payload_not_available": "offline",
-                        "device": {
-                            "identifiers": ["cis3_device"],
-                            "name": "CIS3 Device",
-                            "model": "CIS3 PCB V3.0",
-                            "manufacturer": "biCOMM Design Ltd"
-                        }
-                    }
-                else:
-                    sensor = {
-                        "name": f"CIS3 Channel {i} Resistance",
-                        "unique_id": f"cis3_{channel}_resistance",
-                        "state_topic": f"cis3/{channel}/resistance",
-                        "unit_of_measurement": "Ω",
-                        "icon": "mdi:water-percent",
-                        "value_template": "{{ value }}",
-                        "availability_topic": "cis3/status",
-                        "payload_available": "online",
-                        "payload_not_available": "offline",
-                        "device": {
-                            "identifiers": ["cis3_device"],
-                            "name": "CIS3 Device",
-                            "model": "CIS3 PCB V3.0",
-                            "manufacturer": "biCOMM Design Ltd"
-                        }
-                    }
-                discovery_topic = f"{MQTT_DISCOVERY_PREFIX}/sensor/{sensor['unique_id']}/config"
-                self.client.publish(discovery_topic, json.dumps(sensor), retain=True)
-                logger.info(f"Published MQTT discovery for {sensor['name']} to {discovery_topic}")
-
-            # MQTT Discovery for Slave Sensors (Temperature, Humidity)
-            for sensor_key in ["Temperature", "Humidity"]:
-                sensor_lower = sensor_key.lower()
+    def _build_discovery_msgs(self):
+        """
+        Builds all MQTT discovery (topic, payload, description) tuples once.
+        """
+        msgs = []
+
+        # MQTT Discovery for ADC Channels
+        for i in range(6):
+            channel = f"channel_{i}"
+            if i < 4:
+                sensor = {
+                    **DISCOVERY_BASE,
+                    "name": f"CIS3 Channel {i} Voltage",
+                    "unique_id": f"cis3_{channel}_voltage",
+                    "state_topic": STATE_TOPIC,
+                    "unit_of_measurement": "V",
+                    "device_class": "voltage",
+                    "icon": "mdi:flash",
+                    "value_template": f"{{{{ value_json.adc.{channel}.voltage | round(2) }}}}"
+                }
+            else:
                 sensor = {
-                    "name": f"CIS3 Slave 1 {sensor_key}",
-                    "unique_id": f"cis3_slave_1_{sensor_lower}",
-                    "state_topic": f"cis3/slave_1/{sensor_lower}",
-                    "unit_of_measurement": "%" if sensor_key == "Humidity" else "°C",
-                    "device_class": "humidity" if sensor_key == "Humidity" else "temperature",
-                    "icon": "mdi:water-percent" if sensor_key == "Humidity" else "mdi:thermometer",
-                    "value_template": "{{ value }}",
-                    "availability_topic": "cis3/status",
-                    "payload_available": "online",
-                    "payload_not_available": "offline",
-                    "device": {
-                        "identifiers": ["cis3_device"],
-                        "name": "CIS3 Device",
-                        "model": "CIS3 PCB V3.0",
-                        "manufacturer": "biCOMM Design Ltd"
-                    }
+                    **DISCOVERY_BASE,
+                    "name": f"CIS3 Channel {i} Resistance",
+                    "unique_id": f"cis3_{channel}_resistance",
+                    "state_topic": STATE_TOPIC,
+                    "unit_of_measurement": "Ω",
+                    "icon": "mdi:water-percent",
+                    "value_template": f"{{{{ value_json.adc.{channel}.resistance | round(2) }}}}"
                 }
-                disc_topic = f"{MQTT_DISCOVERY_PREFIX}/sensor/{sensor['unique_id']}/config"
-                self.client.publish(disc_topic, json.dumps(sensor), retain=True)
-                logger.info(f"Published MQTT discovery for {sensor['name']} to {disc_topic}")
+            discovery_topic = f"{MQTT_DISCOVERY_PREFIX}/sensor/{sensor['unique_id']}/config"
+            msgs.append((discovery_topic, orjson.dumps(sensor), sensor['name']))
 
-            # MQTT Discovery for CAN status
+        # MQTT Discovery for Slave Sensors (Temperature, Humidity)
+        for sensor_key in ["Temperature", "Humidity"]:
+            sensor_lower = sensor_key.lower()
             sensor = {
-                "name": "CIS3 CAN Communication",
-                "unique_id": "cis3_can_status",
-                "state_topic": "cis3/can/status",
-                "unit_of_measurement": "",
-                "icon": "mdi:bus-alert",
-                "value_template": "{{ value }}",
-                "availability_topic": "cis3/status",
-                "payload_available": "online",
-                "payload_not_available": "offline",
-                "device": {
-                    "identifiers": ["cis3_device"],
-                    "name": "CIS3 Device",
-                    "model": "CIS3 PCB V3.0",
-                    "manufacturer": "biCOMM Design Ltd"
-                }
-            }
-            disc_topic = f"{MQTT_DISCOVERY_PREFIX}/sensor/cis3_can_status/config"
-            self.client.publish(disc_topic, json.dumps(sensor), retain=True)
-            logger.info(f"Published MQTT discovery for CAN status to {disc_topic}")
-
-            # MQTT Discovery for PWM fan enable (switch)
-            switch_cfg = {
-                "name": "CIS3 PWM Fan Enable",
-                "unique_id": "cis3_fan_enable",
-                "command_topic": "cis3/fan/enable/set",
-                "state_topic": "cis3/fan/enable/state",
-                "payload_on": "ON",
-                "payload_off": "OFF",
-                "icon": "mdi:fan",
-                "availability_topic": "cis3/status",
-                "payload_available": "online",
-                "payload_not_available": "offline",
-                "device": {
-                    "identifiers": ["cis3_device"],
-                    "name": "CIS3 Device",
-                    "model": "CIS3 PCB V3.0",
-                    "manufacturer": "biCOMM Design Ltd"
-                }
-            }
-            self.client.publish(f"{MQTT_DISCOVERY_PREFIX}/switch/{switch_cfg['unique_id']}/config", json.dumps(switch_cfg), retain=True)
-            logger.info("Published MQTT discovery for fan enable switch")
-
-            # MQTT Discovery for PWM duty (number)
-            number_cfg = {
-                "name": "CIS3 PWM Fan Duty",
-                "unique_id": "cis3_fan_duty",
-                "command_topic": "cis3/fan/duty/set",
-                "state_topic": "cis3/fan/duty/state",
-                "min": 10,
-                "max": 100,
-                "step": 1,
-                "unit_of_measurement": "%",
-                "icon": "mdi:fan-speed-1",
-                "availability_topic": "cis3/status",
-                "payload_available": "online",
-                "payload_not_available": "offline",
-                "device": {
-                    "identifiers": ["cis3_device"],
-                    "name": "CIS3 Device",
-                    "model": "CIS3 PCB V3.0",
-                    "manufacturer": "biCOMM Design Ltd"
-                }
+                **DISCOVERY_BASE,
+                "name": f"CIS3 Slave 1 {sensor_key}",
+                "unique_id": f"cis3_slave_1_{sensor_lower}",
+                "state_topic": STATE_TOPIC,
+                "unit_of_measurement": "%" if sensor_key == "Humidity" else "°C",
+                "device_class": "humidity" if sensor_key == "Humidity" else "temperature",
+                "icon": "mdi:water-percent" if sensor_key == "Humidity" else "mdi:thermometer",
+                "value_template": f"{{{{ value_json.slave_1.{sensor_key} }}}}"
             }
-            self.client.publish(f"{MQTT_DISCOVERY_PREFIX}/number/{number_cfg['unique_id']}/config", json.dumps(number_cfg), retain=True)
-            logger.info("Published MQTT discovery for fan duty number")
-
-            # MQTT Discovery for RPM sensor
-            rpm_cfg = {
-                "name": "CIS3 PWM Fan RPM",
-                "unique_id": "cis3_fan_rpm",
-                "state_topic": "cis3/fan/rpm",
-                "unit_of_measurement": "rpm",
-                "icon": "mdi:speedometer",
-                "value_template": "{{ value }}",
-                "availability_topic": "cis3/status",
-                "payload_available": "online",
-                "payload_not_available": "offline",
-                "device": {
-                    "identifiers": ["cis3_device"],
-                    "name": "CIS3 Device",
-                    "model": "CIS3 PCB V3.0",
-                    "manufacturer": "biCOMM Design Ltd"
-                }
-            }
-            self.client.publish(f"{MQTT_DISCOVERY_PREFIX}/sensor/{rpm_cfg['unique_id']}/config", json.dumps(rpm_cfg), retain=True)
-            logger.info("Published MQTT discovery for fan RPM sensor")
+            disc_topic = f"{MQTT_DISCOVERY_PREFIX}/sensor/{sensor['unique_id']}/config"
+            msgs.append((disc_topic, orjson.dumps(sensor), sensor['name']))
+
+        # MQTT Discovery for CAN status
+        sensor = {
+            **DISCOVERY_BASE,
+            "name": "CIS3 CAN Communication",
+            "unique_id": "cis3_can_status",
+            "state_topic": STATE_TOPIC,
+            "unit_of_measurement": "",
+            "icon": "mdi:bus-alert",
+            "value_template": "{{ value_json.can }}"
+        }
+        disc_topic = f"{MQTT_DISCOVERY_PREFIX}/sensor/cis3_can_status/config"
+        msgs.append((disc_topic, orjson.dumps(sensor), "CAN status"))
+
+        # MQTT Discovery for PWM fan enable (switch)
+        switch_cfg = {
+            **DISCOVERY_BASE,
+            "name": "CIS3 PWM Fan Enable",
+            "unique_id": "cis3_fan_enable",
+            "command_topic": "cis3/fan/enable/set",
+            "state_topic": "cis3/fan/enable/state",
+            "payload_on": "ON",
+            "payload_off": "OFF",
+            "icon": "mdi:fan"
+        }
+        msgs.append((f"{MQTT_DISCOVERY_PREFIX}/switch/{switch_cfg['unique_id']}/config",
+                     orjson.dumps(switch_cfg), "fan enable switch"))
+
+        # MQTT Discovery for PWM duty (number)
+        number_cfg = {
+            **DISCOVERY_BASE,
+            "name": "CIS3 PWM Fan Duty",
+            "unique_id": "cis3_fan_duty",
+            "command_topic": "cis3/fan/duty/set",
+            "state_topic": "cis3/fan/duty/state",
+            "min": 10,
+            "max": 100,
+            "step": 1,
+            "unit_of_measurement": "%",
+            "icon": "mdi:fan-speed-1"
+        }
+        msgs.append((f"{MQTT_DISCOVERY_PREFIX}/number/{number_cfg['unique_id']}/config",
+                     orjson.dumps(number_cfg), "fan duty number"))
+
+        # MQTT Discovery for RPM sensor
+        rpm_cfg = {
+            **DISCOVERY_BASE,
+            "name": "CIS3 PWM Fan RPM",
+            "unique_id": "cis3_fan_rpm",
+            "state_topic": STATE_TOPIC,
+            "unit_of_measurement": "rpm",
+            "icon": "mdi:speedometer",
+            "value_template": "{{ value_json.fan.rpm }}"
+        }
+        msgs.append((f"{MQTT_DISCOVERY_PREFIX}/sensor/{rpm_cfg['unique_id']}/config",
+                     orjson.dumps(rpm_cfg), "fan RPM sensor"))
+
+        return msgs
+
+    def publish_mqtt_discovery(self):
+        try:
+            for topic, payload, description in self._discovery_msgs:
+                self.client.publish(topic, payload, qos=QOS, retain=True)
+                logger.info("Published MQTT discovery for %s to %s", description, topic)
         except Exception as e:
             logger.error(f"Error publishing MQTT discovery: {e}")
@@ -1,78 +1,198 @@
 import os
+import fcntl
+import ctypes
+import struct
 import logging
-import threading
 import time
 import json
-import urllib.request
-import urllib.error
+import http.client
+import collections
+
+import numpy as np
 
 logger = logging.getLogger(__name__)
 
+# ============================
+# Linux GPIO character device v2 uAPI (linux/gpio.h)
+# ============================
+# Тахометърът се брои в kernel-а: всеки rising edge увеличава line_seqno на
+# линията, а get_rpm чете само последното събитие веднъж в секунда.
+GPIO_V2_LINES_MAX = 64
+GPIO_MAX_NAME_SIZE = 32
+GPIO_V2_LINE_NUM_ATTRS_MAX = 10
+
+GPIO_V2_LINE_FLAG_INPUT = 1 << 2
+GPIO_V2_LINE_FLAG_EDGE_RISING = 1 << 4
+GPIO_V2_LINE_FLAG_BIAS_PULL_UP = 1 << 8
+
+GPIO_V2_LINE_ATTR_ID_DEBOUNCE = 3
+
+class GpioV2LineAttribute(ctypes.Structure):
+    _fields_ = [
+        ("id", ctypes.c_uint32),
+        ("padding", ctypes.c_uint32),
+        ("value", ctypes.c_uint64),  # union: flags / values / debounce_period_us
+    ]
+
+class GpioV2LineConfigAttribute(ctypes.Structure):
+    _fields_ = [
+        ("attr", GpioV2LineAttribute),
+        ("mask", ctypes.c_uint64),
+    ]
+
+class GpioV2LineConfig(ctypes.Structure):
+    _fields_ = [
+        ("flags", ctypes.c_uint64),
+        ("num_attrs", ctypes.c_uint32),
+        ("padding", ctypes.c_uint32 * 5),
+        ("attrs", GpioV2LineConfigAttribute * GPIO_V2_LINE_NUM_ATTRS_MAX),
+    ]
+
+class GpioV2LineRequest(ctypes.Structure):
+    _fields_ = [
+        ("offsets", ctypes.c_uint32 * GPIO_V2_LINES_MAX),
+        ("consumer", ctypes.c_char * GPIO_MAX_NAME_SIZE),
+        ("config", GpioV2LineConfig),
+        ("num_lines", ctypes.c_uint32),
+        ("event_buffer_size", ctypes.c_uint32),
+        ("padding", ctypes.c_uint32 * 5),
+        ("fd", ctypes.c_int32),
+    ]
+
+# struct gpio_v2_line_event: timestamp_ns, id, offset, seqno, line_seqno, padding[6]
+GPIO_V2_LINE_EVENT_SIZE = 48
+GPIO_V2_LINE_EVENT_FMT = "=Q12xI"  # -> (timestamp_ns, line_seqno)
+
+def _iowr(type_, nr, size):
+    return (3 << 30) | (size << 16) | (type_ << 8) | nr
+
+GPIO_V2_GET_LINE_IOCTL = _iowr(0xB4, 0x07, ctypes.sizeof(GpioV2LineRequest))
+
+INIT_RETRY_INTERVAL_NS = 30 * 1_000_000_000  # retry daemon init at most every 30 s
+DUTY_LOG_INTERVAL_NS = 1_000_000_000  # rate limit for the duty-change info log
+RPM_ALPHA = 0.3  # EMA коефициент за RPM
+
+TACH_EVENT_BUFFER = 16  # kernel FIFO; при препълване се губят най-старите събития
+TACH_EDGE_HISTORY = 64  # последни (line_seqno, timestamp_ns) за медианния период
+
+
+def request_edge_line(chip_path, offset, debounce_us=0, consumer=b"cis3-tach"):
+    """
+    Requests a GPIO line as a pulled-up input with rising-edge events and
+    returns the non-blocking line event fd. With debounce_us the kernel
+    drops edges until the line has been stable for that long.
+    """
+    req = GpioV2LineRequest()
+    req.offsets[0] = offset
+    req.consumer = consumer
+    req.config.flags = (GPIO_V2_LINE_FLAG_INPUT | GPIO_V2_LINE_FLAG_EDGE_RISING |
+                        GPIO_V2_LINE_FLAG_BIAS_PULL_UP)
+    if debounce_us:
+        cfg_attr = req.config.attrs[0]
+        cfg_attr.attr.id = GPIO_V2_LINE_ATTR_ID_DEBOUNCE
+        cfg_attr.attr.value = debounce_us
+        cfg_attr.mask = 1  # bit 0 = offsets[0]
+        req.config.num_attrs = 1
+    req.num_lines = 1
+    req.event_buffer_size = TACH_EVENT_BUFFER
+
+    chip_fd = os.open(chip_path, os.O_RDONLY | os.O_CLOEXEC)
+    try:
+        fcntl.ioctl(chip_fd, GPIO_V2_GET_LINE_IOCTL, req)
+    finally:
+        os.close(chip_fd)
+    os.set_blocking(req.fd, False)
+    return req.fd
+
 class PWMManager:
     """PWM Manager с HTTP комуникация към host daemon"""
     
-    def __init__(self, pwm_pin=12, tachometer_pin=13, frequency=26000, pulses_per_rev=2):
+    __slots__ = (
+        'pwm_pin', 'tachometer_pin', 'frequency', 'pulses_per_rev', 'tach_debounce_us',
+        'daemon_host', 'daemon_port', 'base_url', '_conn',
+        'duty_cycle', 'is_enabled', 'is_initialized', '_last_init_attempt',
+        '_pending_duty', '_written_duty', '_last_duty_log',
+        'rpm', '_rpm_ema', '_rpm_scale', 'last_rpm_calc',
+        'tach_chip', 'tach_fd', '_tach_seqno', '_tach_ts', '_tach_buf', '_tach_edges',
+    )
+    
+    def __init__(self, pwm_pin=12, tachometer_pin=13, frequency=26000, pulses_per_rev=2,
+                 tach_debounce_us=0):
         self.pwm_pin = pwm_pin
         self.tachometer_pin = tachometer_pin
         self.frequency = frequency
         self.pulses_per_rev = pulses_per_rev
+        self.tach_debounce_us = tach_debounce_us
         
         # HTTP клиент настройки
         self.daemon_host = os.getenv("PWM_DAEMON_HOST", "172.30.32.1")  # HAOS host IP
         self.daemon_port = int(os.getenv("PWM_DAEMON_PORT", "9000"))
         self.base_url = f"http://{self.daemon_host}:{self.daemon_port}"
+        # Една keep-alive връзка за всички заявки (http.client се свързва при нужда)
+        self._conn = http.client.HTTPConnection(self.daemon_host, self.daemon_port, timeout=5)
         
         # PWM state
         self.duty_cycle = 10  # percentage 10-100%
         self.is_enabled = False
         self.is_initialized = False
+        self._pending_duty = None  # staged by set_duty_cycle, sent by commit()
+        self._written_duty = None  # last duty the daemon acknowledged
+        self._last_duty_log = 0
         
         # Tachometer
         self.rpm = 0
-        self.tachometer_pulses = 0
-        self.tachometer_lock = threading.Lock()
-        self.last_rpm_calc = time.time()
+        self._rpm_ema = 0.0
+        self._rpm_scale = 60_000_000_000 / pulses_per_rev  # pulses/ns -> rpm
+        self.tach_chip = f"/dev/gpiochip{os.getenv('RPI_LGPIO_CHIP', '4')}"
+        self.tach_fd = None
+        self._tach_seqno = 0  # last line_seqno seen from the kernel
+        self._tach_ts = 0  # kernel timestamp of that edge, 0 = no recent edge
+        self._tach_buf = bytearray(GPIO_V2_LINE_EVENT_SIZE * TACH_EVENT_BUFFER)
+        self._tach_edges = collections.deque(maxlen=TACH_EDGE_HISTORY)
+        self.last_rpm_calc = time.monotonic_ns()
+        self._setup_tachometer()
         
         # Проверка за връзка с daemon
-        logger.info(f"PWM Manager: Connecting to daemon at {self.base_url}")
+        self._last_init_attempt = time.monotonic_ns()
+        logger.info("PWM Manager: Connecting to daemon at %s", self.base_url)
         if self._check_daemon_connection():
             # Инициализация на PWM през daemon
             self.initialize_pwm(self.frequency)
         else:
-            logger.warning(f"PWM daemon not accessible at {self.base_url}")
+            logger.warning("PWM daemon not accessible at %s", self.base_url)
             logger.warning("Make sure pwm-daemon is running on host (sudo systemctl status pwm-daemon)")
     
     def _make_request(self, endpoint, method="GET", data=None):
-        """HTTP заявка към PWM daemon"""
-        url = f"{self.base_url}{endpoint}"
+        """HTTP заявка към PWM daemon през постоянната keep-alive връзка"""
+        headers = {}
+        body = None
+        if method == "POST":
+            headers = {'Content-Type': 'application/json'}
+            body = json.dumps(data).encode() if data else b'{}'
         
-        try:
-            if method == "GET":
-                with urllib.request.urlopen(url, timeout=5) as response:
+        for attempt in range(2):
+            try:
+                self._conn.request(method, endpoint, body=body, headers=headers)
+                with self._conn.getresponse() as response:
                     return json.loads(response.read().decode())
-            
-            elif method == "POST":
-                headers = {'Content-Type': 'application/json'}
-                json_data = json.dumps(data).encode() if data else b'{}'
-                req = urllib.request.Request(url, data=json_data, headers=headers, method='POST')
-                
-                with urllib.request.urlopen(req, timeout=5) as response:
-                    return json.loads(response.read().decode())
-        
-        except urllib.error.URLError as e:
-            logger.debug(f"Connection error to {url}: {e}")
-            return None
-        except Exception as e:
-            logger.debug(f"Request error to {url}: {e}")
-            return None
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError) as e:
+                # Daemon-ът е затворил неактивната връзка - отвори нова веднъж
+                self._conn.close()
+                if attempt:
+                    logger.debug("Connection error to %s%s: %s", self.base_url, endpoint, e)
+                    return None
+            except Exception as e:
+                self._conn.close()
+                logger.debug("Request error to %s%s: %s", self.base_url, endpoint, e)
+                return None
     
     def _check_daemon_connection(self):
         """Провери връзка с daemon"""
         result = self._make_request("/status", "GET")
         if result and result.get("status") == "ok":
-            logger.info(f"✓ Connected to pwm-daemon at {self.base_url}")
+            logger.info("✓ Connected to pwm-daemon at %s", self.base_url)
             return True
-        logger.error(f"✗ Cannot connect to pwm-daemon at {self.base_url}")
+        logger.error("✗ Cannot connect to pwm-daemon at %s", self.base_url)
         return False
     
     def initialize_pwm(self, frequency: int = 26000):
@@ -80,11 +200,11 @@ class PWMManager:
         try:
             self.frequency = frequency
             
-            logger.info(f"========================================")
-            logger.info(f"Initializing PWM via daemon:")
-            logger.info(f"  - GPIO Pin: {self.pwm_pin}")
-            logger.info(f"  - Frequency: {frequency} Hz ({frequency/1000} kHz)")
-            logger.info(f"  - Daemon: {self.base_url}")
+            logger.info("========================================")
+            logger.info("Initializing PWM via daemon:")
+            logger.info("  - GPIO Pin: %s", self.pwm_pin)
+            logger.info("  - Frequency: %s Hz (%s kHz)", frequency, frequency / 1000)
+            logger.info("  - Daemon: %s", self.base_url)
             
             data = {
                 "gpio_pin": self.pwm_pin,
@@ -94,7 +214,9 @@ class PWMManager:
             result = self._make_request("/init", "POST", data)
             if result and result.get("status") == "ok":
                 self.is_initialized = True
-                logger.info(f"✓✓✓ PWM initialized successfully via daemon ✓✓✓")
+                # The daemon starts the channel at 0%, nothing valid was sent yet
+                self._written_duty = None
+                logger.info("✓✓✓ PWM initialized successfully via daemon ✓✓✓")
                 logger.info("========================================")
                 return True
             
@@ -103,44 +225,74 @@ class PWMManager:
             self.is_initialized = False
             return False
             
-        except Exception as e:
+        except Exception:
             logger.error("========================================")
-            logger.error(f"✗✗✗ ERROR initializing PWM: {e} ✗✗✗")
+            logger.exception("✗✗✗ ERROR initializing PWM ✗✗✗")
             logger.error("========================================")
-            import traceback
-            logger.error(traceback.format_exc())
             self.is_initialized = False
             return False
     
-    def set_duty_cycle(self, duty_cycle):
-        """Set PWM duty cycle (10-100%)"""
-        if not self.is_initialized:
+    def _ensure_initialized(self):
+        """Retry daemon initialization if it failed earlier (rate limited)"""
+        if self.is_initialized:
+            return True
+        now = time.monotonic_ns()
+        if now - self._last_init_attempt < INIT_RETRY_INTERVAL_NS:
+            return False
+        self._last_init_attempt = now
+        return self.initialize_pwm(self.frequency)
+    
+    def set_duty_cycle(self, duty_cycle, apply=True):
+        """Set PWM duty cycle (10-100%); with apply=False it is only staged for commit()"""
+        if not self._ensure_initialized():
             logger.warning("PWM not initialized, cannot set duty cycle")
             return False
         
+        # Whole percents only: matches the daemon's duty table and the change check
+        duty_cycle = int(duty_cycle)
         if 10 <= duty_cycle <= 100:
             self.duty_cycle = duty_cycle
-            
-            # Update duty cycle via daemon
-            data = {
-                "gpio_pin": self.pwm_pin,
-                "duty_cycle": duty_cycle
-            }
-            
-            result = self._make_request("/duty", "POST", data)
-            if result and result.get("status") == "ok":
-                logger.info(f"PWM duty cycle set to {duty_cycle}%")
-                return True
-            else:
-                logger.error(f"Failed to set duty cycle to {duty_cycle}%")
-                return False
+            self._pending_duty = duty_cycle
+            if apply:
+                return self.commit()
+            return True
         else:
-            logger.warning(f"Duty cycle {duty_cycle}% out of range (10-100%)")
+            logger.warning("Duty cycle %s%% out of range (10-100%%)", duty_cycle)
+            return False
+    
+    def commit(self):
+        """Send the staged duty cycle to the daemon, unless it was already sent"""
+        duty_cycle = self._pending_duty
+        if duty_cycle is None:
+            return True
+        if duty_cycle == self._written_duty:
+            self._pending_duty = None
+            return True
+        
+        # Update duty cycle via daemon
+        data = {
+            "gpio_pin": self.pwm_pin,
+            "duty_cycle": duty_cycle
+        }
+        
+        result = self._make_request("/duty", "POST", data)
+        if result and result.get("status") == "ok":
+            self._written_duty = duty_cycle
+            self._pending_duty = None
+            # At most one info line per second, even if duty is changed faster
+            now = time.monotonic_ns()
+            if now - self._last_duty_log >= DUTY_LOG_INTERVAL_NS:
+                self._last_duty_log = now
+                logger.info("PWM duty cycle set to %s%%", duty_cycle)
+            return True
+        else:
+            # Stays pending, the next commit() retries
+            logger.error("Failed to set duty cycle to %s%%", duty_cycle)
             return False
     
     def enable_pwm(self):
         """Enable PWM output"""
-        if not self.is_initialized:
+        if not self._ensure_initialized():
             logger.error("PWM not initialized")
             return False
         
@@ -171,9 +323,72 @@ class PWMManager:
             logger.error("Failed to disable PWM")
             return False
     
+    def _setup_tachometer(self):
+        """Request the tachometer line with kernel-side edge counting"""
+        try:
+            self.tach_fd = request_edge_line(self.tach_chip, self.tachometer_pin,
+                                             debounce_us=self.tach_debounce_us)
+            logger.info("Tachometer on %s line %s (debounce %s us)",
+                        self.tach_chip, self.tachometer_pin, self.tach_debounce_us)
+        except Exception as e:
+            self.tach_fd = None
+            logger.warning("Tachometer not available on %s: %s", self.tach_chip, e)
+    
+    def _read_tach_event(self):
+        """Drain pending edge events into the edge history and return (line_seqno, timestamp_ns) of the newest"""
+        seqno, ts = self._tach_seqno, self._tach_ts
+        buf = self._tach_buf
+        edges = self._tach_edges
+        while True:
+            try:
+                n = os.readv(self.tach_fd, [buf])
+            except BlockingIOError:
+                break
+            for off in range(0, n - GPIO_V2_LINE_EVENT_SIZE + 1, GPIO_V2_LINE_EVENT_SIZE):
+                ts, seqno = struct.unpack_from(GPIO_V2_LINE_EVENT_FMT, buf, off)
+                edges.append((seqno, ts))
+            if n < len(buf):
+                break
+        return seqno, ts
+    
+    def _median_period_ns(self):
+        """Median time per pulse over the edge history, or 0 with fewer than 2 edges"""
+        if len(self._tach_edges) < 2:
+            return 0
+        edges = np.array(self._tach_edges, dtype=np.int64)
+        # Препълване на kernel FIFO-то прескача seqno: делим на броя импулси
+        pulses = np.diff(edges[:, 0]) & 0xFFFFFFFF
+        return float(np.median(np.diff(edges[:, 1]) / pulses))
+    
     def get_rpm(self):
-        """Calculate RPM (placeholder - tachometer not implemented yet)"""
-        # TODO: Implement GPIO tachometer reading
+        """Calculate RPM from the edges the kernel counted since the previous call"""
+        if self.tach_fd is None:
+            return self.rpm
+        
+        now = time.monotonic_ns()
+        seqno, ts = self._read_tach_event()
+        pulses = (seqno - self._tach_seqno) & 0xFFFFFFFF
+        
+        elapsed_ns = now - self.last_rpm_calc
+        self.last_rpm_calc = now
+        period_ns = self._median_period_ns() if pulses and self._tach_ts else 0
+        if period_ns > 0:
+            # Median kernel-timed pulse interval: a single glitch or missed
+            # edge does not move it, unlike a plain count over the window
+            pulses, span_ns = 1, period_ns
+        else:
+            # First edges after a stop (or no edges): fall back to the window
+            span_ns = elapsed_ns
+            if not pulses:
+                self._tach_edges.clear()
+        self._tach_seqno = seqno
+        self._tach_ts = ts if pulses else 0
+        
+        if span_ns > 0:
+            inst_rpm = pulses * self._rpm_scale / span_ns
+            # EMA smooths the +/-1 pulse quantization of a single interval
+            self._rpm_ema += RPM_ALPHA * (inst_rpm - self._rpm_ema)
+            self.rpm = int(self._rpm_ema)
         return self.rpm
     
     def get_status(self):
@@ -190,6 +405,10 @@ class PWMManager:
         try:
             if self.is_enabled:
                 self.disable_pwm()
+            if self.tach_fd is not None:
+                os.close(self.tach_fd)
+                self.tach_fd = None
+            self._conn.close()
             logger.info("PWM Manager closed")
         except Exception as e:
             logger.error(f"Error closing PWM: {e}")
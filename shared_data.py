@@ -23,3 +23,22 @@ latest_data = {
         "frequency": 26000
     }
 }
+
+# Fixed ADC layout: (channel, measured field, unit)
+ADC_FIELDS = tuple(
+    (f"channel_{i}", "voltage", "V") if i < 4 else (f"channel_{i}", "resistance", "Ω")
+    for i in range(6)
+)
+# ADC values are quantized to the precision shown in Home Assistant,
+# so readings that only differ by EMA noise are not republished
+ADC_DECIMALS = 2
+
+def quantize_adc(channels):
+    """
+    Returns a copy of the ADC channels with values rounded to ADC_DECIMALS.
+    The filters keep full precision; MQTT and WebSocket publish this view.
+    """
+    return {
+        name: {field: round(channels[name][field], ADC_DECIMALS), "unit": unit}
+        for name, field, unit in ADC_FIELDS
+    }
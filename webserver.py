@@ -1,15 +1,15 @@
 # webserver.py
 
 import os
-import json
 import logging
 import asyncio
+import orjson
 from quart import Quart, jsonify, send_from_directory, websocket, request
 from hypercorn.asyncio import serve
 from hypercorn.config import Config
 
 from logger_config import logger
-from shared_data import latest_data
+from shared_data import latest_data, quantize_adc
 
 quart_log = logging.getLogger('quart.app')
 quart_log.setLevel(logging.ERROR)
@@ -19,6 +19,14 @@ BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 app = Quart(__name__)
 clients = set()
 mqtt_client = None
+_last_payload = None  # последният изпратен WS payload
+
+def _encode_state():
+    """
+    JSON текст за WS клиентите. ADC стойностите са закръглени като в MQTT,
+    така шум под 0.01 не поражда нов frame.
+    """
+    return orjson.dumps({**latest_data, "adc_channels": quantize_adc(latest_data["adc_channels"])}).decode()
 
 def set_mqtt_client(client):
     global mqtt_client
@@ -72,6 +80,9 @@ async def ws_route():
     logger.info("New WebSocket connection established.")
     clients.add(websocket._get_current_object())
     try:
+        # Новият клиент не чака следваща промяна на данните; кодира се наново,
+        # защото _last_payload не се обновява докато няма клиенти
+        await websocket.send(_encode_state())
         while True:
             await websocket.receive()  # Изчакваме съобщения от клиента
     except asyncio.CancelledError:
@@ -79,16 +90,29 @@ async def ws_route():
     except Exception as e:
         logger.error(f"WebSocket error: {e}")
     finally:
-        clients.remove(websocket._get_current_object())
+        clients.discard(websocket._get_current_object())
         logger.info("WebSocket connection closed.")
 
 async def broadcast_via_websocket():
     """
     Праща последните данни на всички WS клиенти.
     """
+    global _last_payload
     if clients:
-        data_to_send = json.dumps(latest_data)
-        await asyncio.gather(*(client.send(data_to_send) for client in clients))
+        # Един JSON payload за всички клиенти (текстов frame за JSON.parse в index.html)
+        data_to_send = _encode_state()
+        if data_to_send == _last_payload:
+            # Нищо не се е променило от предишния tick
+            return
+        _last_payload = data_to_send
+        # Снимка на клиентите: ws_route може да промени set-а по време на gather
+        targets = list(clients)
+        results = await asyncio.gather(*(client.send(data_to_send) for client in targets),
+                                       return_exceptions=True)
+        for client, result in zip(targets, results):
+            if isinstance(result, Exception):
+                # Мъртъв клиент - не плащаме send за него на всеки tick
+                clients.discard(client)
         logger.debug("Sent updated data to WebSocket clients.")
 
 async def run_quart_server(http_port):